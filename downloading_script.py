@@ -1,30 +1,78 @@
 import asyncio
+import atexit
 import os
 import csv
 import json
 import random
+import re
+import signal
 import time
 from datetime import datetime, timezone
 from TikTokApi import TikTokApi
 
+try:
+    from TikTokApi.exceptions import EmptyResponseException
+except ImportError:
+    EmptyResponseException = None  # older TikTokApi layouts
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # stdlib json still works, just slower
+
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None  # chunk writes fall back to asyncio.to_thread
+
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:
+    ScalableBloomFilter = None
+
 # ================== Configuration ==================
 ms_token      = os.environ.get("ms_token", "YOUR_MS_TOKEN_HERE")
 DOWNLOAD_DIR  = os.environ.get("DOWNLOAD_DIR", "downloads")
 DATA_CSV_PATH = os.environ.get("DATA_CSV_PATH", "tiktok_trending_dataset.csv")
 DATA_JSONL    = os.environ.get("DATA_JSONL", "tiktok_trending_dataset.jsonl")
+MUSIC_CACHE_PATH = os.environ.get("MUSIC_CACHE_PATH", "music_cache.json")
 
 # How many FINAL successfully downloaded videos you want:
 COUNT         = int(os.environ.get("COUNT", "1000"))
 
-# Safer paging: request small pages repeatedly
-PAGE_SIZE     = int(os.environ.get("PAGE_SIZE", "20"))  # 30–80 is usually safe
+# Safer paging: request small pages repeatedly (PAGE_SIZE is the starting point;
+# the loop adapts within [PAGE_SIZE_MIN, PAGE_SIZE_MAX] based on recent errors)
+PAGE_SIZE       = int(os.environ.get("PAGE_SIZE", "20"))  # 30–80 is usually safe
+PAGE_SIZE_MIN   = 5
+PAGE_SIZE_MAX   = int(os.environ.get("PAGE_SIZE_MAX", "80"))
+PAGE_GROWTH     = 1.2   # optimistic multiplier applied to a clean page size
+PAGE_ERR_ALPHA  = 0.3   # EMA weight for the recent page-error rate
+PAGE_GROW_AFTER = int(os.environ.get("PAGE_GROW_AFTER", "3"))  # clean pages before +5
+
+# How many videos to process in flight at once (network-bound, so overlap RTTs)
+CONCURRENCY   = int(os.environ.get("CONCURRENCY", "6"))
+
+# Flush CSV/JSONL to disk every N rows instead of after every single row
+FLUSH_EVERY   = int(os.environ.get("FLUSH_EVERY", "25"))
+FILE_BUFFER_SIZE = 1 << 20  # 1 MiB userspace buffer keeps syscalls rare
+DOWNLOAD_CHUNK_SIZE = 1 << 16  # stream MP4s in 64 KiB chunks instead of whole-file
+
+# How long the music loader waits to coalesce lookups into one batch
+MUSIC_BATCH_WINDOW_MS = int(os.environ.get("MUSIC_BATCH_WINDOW_MS", "20"))
+
+# Client-side token bucket: stay under TikTok's rate limit instead of
+# bouncing off it (10201 + backoff + session reset is far more expensive)
+RATE_LIMIT_RPS   = float(os.environ.get("RATE_LIMIT_RPS", "2.0"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "5"))
+
+# Trending feeds cluster by creator; cache authorStats per uniqueId briefly
+AUTHOR_CACHE_TTL_SEC = float(os.environ.get("AUTHOR_CACHE_TTL_SEC", "300"))
 
 # Backoff / stability
 MAX_LOOPS              = int(os.environ.get("MAX_LOOPS", "999999"))  # outer guard
 MAX_CONSECUTIVE_ERRORS = int(os.environ.get("MAX_CONSECUTIVE_ERRORS", "6"))
 BACKOFF_BASE_SEC       = float(os.environ.get("BACKOFF_BASE_SEC", "2.0"))
 BACKOFF_MAX_SEC        = float(os.environ.get("BACKOFF_MAX_SEC", "30.0"))
-JITTER_SEC             = float(os.environ.get("JITTER_SEC", "0.8"))
 RESET_SESSION_AFTER_ERRORS = int(os.environ.get("RESET_SESSION_AFTER_ERRORS", "3"))
 
 # Popular sound heuristic threshold (if available)
@@ -33,30 +81,189 @@ POPULAR_SOUND_MIN_USES = int(os.environ.get("POPULAR_SOUND_MIN_USES", "1000"))
 # Playwright/browser settings
 TIKTOK_BROWSER = os.environ.get("TIKTOK_BROWSER", "chromium")  # chromium | firefox | webkit
 HEADLESS       = os.environ.get("HEADLESS", "true").lower() in ("1", "true", "yes")
+SESSION_POOL_SIZE = int(os.environ.get("SESSION_POOL_SIZE", "2"))  # warm spares for resets
+
+# Minimal launch profile: the JSON endpoints TikTokApi scrapes never need
+# images/media/fonts/css, so don't spend bandwidth or CPU loading them
+CHROMIUM_ARGS = [
+    "--disable-dev-shm-usage",
+    "--no-sandbox",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--blink-settings=imagesEnabled=false",
+]
+SUPPRESS_RESOURCE_TYPES = ["image", "media", "font", "stylesheet"]
 
 # ================== Helpers ==================
+_HASHTAG_RE = re.compile(r"#\w+", re.UNICODE)
+
+# Column order shared by the CSV header, every data row, and the JSONL keys
+_CSV_FIELDS = (
+    "video_id","watch_url","username",
+    "creator_followers","creator_video_count","creator_total_likes",
+    "avg_likes_per_video",
+    "create_time_iso","video_duration_sec",
+    "hashtags","uses_popular_sound","music_uses_count","popular_sound_reason",
+    "caption","play_count","like_count","comment_count","share_count","download_path",
+)
+_HASHTAGS_IDX = _CSV_FIELDS.index("hashtags")
+
 def _to_iso(ts):
+    # time.gmtime + strftime skips allocating a tz-aware datetime per video
+    # and is noticeably cheaper than datetime.isoformat(); the datetime path
+    # stays as a fallback for pre-epoch/out-of-range weirdness.
     try:
-        return datetime.fromtimestamp(int(ts), tz=timezone.utc).isoformat()
+        return time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(int(ts)))
     except Exception:
-        return None
+        try:
+            return datetime.fromtimestamp(int(ts), tz=timezone.utc).isoformat()
+        except Exception:
+            return None
 
 def _extract_hashtags(data):
-    tags = []
-    for item in (data.get("textExtra") or []):
-        name = item.get("hashtagName")
-        if name:
-            tags.append(f"#{name}")
+    tags = [f"#{i['hashtagName']}" for i in data.get("textExtra") or () if i.get("hashtagName")]
     if not tags:
-        desc = data.get("desc") or ""
-        tags = [w for w in desc.split() if w.startswith("#")]
-    seen, uniq = set(), []
+        tags = _HASHTAG_RE.findall(data.get("desc") or "")
+    # dict keys dedupe case-insensitively while keeping first-seen order/spelling
+    uniq = {}
     for t in tags:
-        tl = t.lower()
-        if tl not in seen:
-            seen.add(tl)
-            uniq.append(t)
-    return uniq
+        uniq.setdefault(t.lower(), t)
+    return list(uniq.values())
+
+def _dumps_jsonl(row):
+    """Serialize one row dict to a bytes line (orjson when available)."""
+    if orjson is not None:
+        return orjson.dumps(row) + b"\n"
+    return (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _write_atomic(path, payload):
+    tmp_path = f"{path}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+def _append_rows(csv_writer, jsonl_file, csv_batch, jsonl_batch):
+    # runs in a worker thread; only ever called from the writer task
+    csv_writer.writerows(csv_batch)
+    jsonl_file.writelines(jsonl_batch)
+
+_WRITE_DONE = object()  # sentinel that tells the writer task to drain and exit
+
+async def _writer_task(write_q, csv_writer, csv_file, jsonl_file):
+    """Single consumer for all row output.
+
+    Every producer just puts (csv_row, jsonl_line) on the queue; one
+    coroutine draining it serializes disk I/O without locks, keeps CSV
+    lines from interleaving, and batches rows naturally — buffers are
+    written when they reach FLUSH_EVERY, when the queue goes idle, or at
+    shutdown.
+
+    If a write fails (disk full, closed handle, …) the task keeps
+    draining the bounded queue — dropping rows — until the shutdown
+    sentinel arrives, so producers never deadlock on a full queue, and
+    then re-raises so the error surfaces when the main task awaits it.
+    """
+    done = False
+    try:
+        buf_csv, buf_jsonl = [], []
+        pending_rows = 0
+        while True:
+            item = await write_q.get()
+            done = item is _WRITE_DONE
+            if not done:
+                csv_row, jsonl_line = item
+                buf_csv.append(csv_row)
+                buf_jsonl.append(jsonl_line)
+            if buf_csv and (done or len(buf_csv) >= FLUSH_EVERY or write_q.empty()):
+                await asyncio.to_thread(_append_rows, csv_writer, jsonl_file, buf_csv, buf_jsonl)
+                pending_rows += len(buf_csv)
+                buf_csv, buf_jsonl = [], []
+                if done or pending_rows >= FLUSH_EVERY:
+                    await asyncio.to_thread(csv_file.flush)
+                    await asyncio.to_thread(jsonl_file.flush)
+                    pending_rows = 0
+            if done:
+                break
+    except Exception as e:
+        print(f"⚠️ writer task failed: {e!r} — dropping further rows")
+        # if the failure hit on the sentinel iteration itself (e.g. ENOSPC
+        # surfacing at the final flush), the sentinel is already consumed —
+        # draining for a second one would hang forever
+        while not done and await write_q.get() is not _WRITE_DONE:
+            pass
+        raise
+
+def _load_seen_ids(seen_ids):
+    """Seed the duplicate filter from the append-only CSV so a restarted
+    run never re-downloads videos it already has."""
+    if not os.path.exists(DATA_CSV_PATH):
+        return 0
+    n = 0
+    try:
+        with open(DATA_CSV_PATH, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if row and row[0] and row[0] != _CSV_FIELDS[0]:
+                    seen_ids.add(row[0])
+                    n += 1
+    except Exception as e:
+        print(f"⚠️ could not seed seen ids from {DATA_CSV_PATH}: {e}")
+    return n
+
+def _load_music_cache():
+    try:
+        with open(MUSIC_CACHE_PATH, encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"⚠️ could not load {MUSIC_CACHE_PATH}: {e}")
+        return {}
+
+def _dump_music_cache(cache):
+    # None means a lookup failed; persisting it would block retries forever,
+    # so only real counts survive across runs
+    try:
+        known = {mid: count for mid, count in cache.items() if count is not None}
+        _write_atomic(MUSIC_CACHE_PATH, json.dumps(known).encode("utf-8"))
+    except Exception as e:
+        print(f"⚠️ could not save {MUSIC_CACHE_PATH}: {e}")
+
+def _exit_on_signal(signum, frame):
+    # raise SystemExit so atexit handlers (cache dump) still run
+    raise SystemExit(128 + signum)
+
+async def _download_video(t, out_path):
+    """Stream the video to `<id>.mp4.part`, then rename atomically.
+
+    Streaming keeps peak memory at one chunk per in-flight download
+    instead of a whole 5–50 MB file; TikTokApi versions without stream
+    support fall back to the buffered t.bytes() path. The .part + rename
+    dance means a crash never leaves a truncated .mp4 behind.
+    """
+    try:
+        stream = await t.bytes(stream=True)
+    except TypeError:
+        stream = None
+    if hasattr(stream, "__aiter__"):
+        # chunk writes go through aiofiles (or the threadpool) so a slow
+        # disk never stalls the other in-flight coroutines
+        tmp_path = f"{out_path}.part"
+        if aiofiles is not None:
+            async with aiofiles.open(tmp_path, "wb", buffering=FILE_BUFFER_SIZE) as f:
+                async for chunk in stream:
+                    await f.write(chunk)
+        else:
+            f = await asyncio.to_thread(open, tmp_path, "wb", buffering=FILE_BUFFER_SIZE)
+            try:
+                async for chunk in stream:
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.replace, tmp_path, out_path)
+    else:
+        video_bytes = stream if isinstance(stream, (bytes, bytearray)) else await t.bytes()
+        await asyncio.to_thread(_write_atomic, out_path, video_bytes)
 
 def _popular_sound_heuristic(music_obj, music_uses_count):
     try:
@@ -71,14 +278,17 @@ def _popular_sound_heuristic(music_obj, music_uses_count):
     except Exception as e:
         return False, f"error:{e}"
 
-async def _fetch_music_usage_count(api, music_obj):
-    if not music_obj:
-        return None
-    music_id = music_obj.get("id") or music_obj.get("musicId") or music_obj.get("idStr")
+async def _fetch_music_usage_count(api, music_id):
+    """Usage count for a sound, or None when the endpoints answer without
+    one. Raises when BOTH endpoints error out, so callers can tell a
+    throttled lookup (worth retrying later) from a sound that genuinely
+    has no count.
+    """
     if not music_id:
         return None
 
     # Try api.music(id=...)
+    music_err = None
     try:
         m = api.music(id=music_id)
         await m.info()
@@ -89,8 +299,8 @@ async def _fetch_music_usage_count(api, music_obj):
             vc = md.get("videoCount")
         if isinstance(vc, int):
             return vc
-    except Exception:
-        pass
+    except Exception as e:
+        music_err = e
 
     # Try api.sound(id=...) as fallback
     try:
@@ -104,180 +314,436 @@ async def _fetch_music_usage_count(api, music_obj):
         if isinstance(vc, int):
             return vc
     except Exception:
-        pass
+        if music_err is not None:
+            raise
 
     return None
 
+class TokenBucket:
+    """Proactive request pacing.
+
+    take() refills tokens from elapsed monotonic time and sleeps when the
+    bucket runs dry, capping the steady-state request rate at `rate`/s
+    with bursts up to `burst`. Every TikTok-bound call grabs a token
+    first, so the scraper preempts 10201s rather than reacting to them.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self, n=1):
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < n:
+                await asyncio.sleep((n - self.tokens) / self.rate)
+                # consume the refill earned during the sleep, otherwise the
+                # next caller double-counts that interval and the bucket
+                # admits ~2× the configured rate under contention
+                self.last = time.monotonic()
+                self.tokens = 0.0
+            else:
+                self.tokens -= n
+
+class _SeenIds:
+    """Duplicate-video filter sized for very long runs.
+
+    TikTok video ids are 19-digit decimals, so they are stored as ints
+    (~28 bytes each vs ~80+ for the strings inside a set). When
+    pybloom_live is installed, a scalable Bloom filter takes over the
+    membership probe (KBs instead of MBs at MAX_LOOPS scale); its 0.1%
+    false-positive rate only means the odd video gets skipped, which an
+    append-only trending scrape can afford.
+    """
+
+    def __init__(self):
+        if ScalableBloomFilter is not None:
+            self._ids = ScalableBloomFilter(initial_capacity=10000, error_rate=0.001)
+        else:
+            self._ids = set()
+
+    @staticmethod
+    def _key(video_id):
+        try:
+            return int(video_id)
+        except (TypeError, ValueError):
+            return video_id
+
+    def add(self, video_id):
+        self._ids.add(self._key(video_id))
+
+    def __contains__(self, video_id):
+        return self._key(video_id) in self._ids
+
+class MusicLoader:
+    """DataLoader-style coalescer for music usage counts.
+
+    get(music_id) hands back one shared future per unique id; pending ids
+    collect for a short window, then are fetched in a single concurrent
+    wave. Many trending videos share a sound, so this both dedupes
+    lookups and turns N sequential round trips into one burst. Resolved
+    counts land in `cache`, so later pages skip the network entirely.
+    """
+
+    def __init__(self, api, cache, bucket=None):
+        self.api = api
+        self.cache = cache
+        self.bucket = bucket
+        self.batch_window = MUSIC_BATCH_WINDOW_MS / 1000.0
+        self.pending = {}          # music_id -> asyncio.Future
+        self._flush_task = None
+
+    async def get(self, music_id):
+        if not music_id:
+            return None
+        if music_id in self.cache:
+            return self.cache[music_id]
+        if music_id not in self.pending:
+            self.pending[music_id] = asyncio.get_running_loop().create_future()
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._flush_soon())
+        return await self.pending[music_id]
+
+    async def _flush_soon(self):
+        # let every item currently in flight pile onto the same batch
+        await asyncio.sleep(self.batch_window)
+        batch, self.pending = self.pending, {}
+        if self.bucket is not None:
+            await self.bucket.take(len(batch))
+        results = await asyncio.gather(
+            *(_fetch_music_usage_count(self.api, mid) for mid in batch),
+            return_exceptions=True,
+        )
+        for mid, res in zip(batch, results):
+            if isinstance(res, BaseException):
+                # resolve waiters but keep the id out of the cache so a
+                # throttled lookup can be retried on a later sighting
+                count = None
+            else:
+                count = res
+                self.cache[mid] = count
+            fut = batch[mid]
+            if not fut.done():
+                fut.set_result(count)
+        # ids that arrived while the gather above was running have no timer
+        # of their own — reschedule so their futures always get resolved
+        if self.pending:
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+async def _process_item(video, api, sem, music_loader, fetch_stats, bucket, author_cache):
+    """Fetch full info + music usage + bytes for one trending video.
+
+    All network calls run under `sem` so at most CONCURRENCY items are in
+    flight at once. Returns the row tuple (in _CSV_FIELDS order) on
+    success, None when only the
+    download failed (matches the old per-item skip), and raises on any
+    other item error so the caller can count it.
+    """
+    data = video.as_dict
+    video_id = data.get("id")
+
+    username = (data.get("author") or {}).get("uniqueId")
+    watch_url = f"https://www.tiktok.com/@{username}/video/{video_id}" if username else None
+
+    async with sem:
+        # Creators repeat within a trending page; a fresh cache entry can
+        # stand in for missing authorStats and save the info() round trip.
+        author_stats = None
+        cached = author_cache.get(username) if username else None
+        if cached is not None and time.monotonic() - cached[1] < AUTHOR_CACHE_TTL_SEC:
+            author_stats = cached[0]
+
+        # Trending entries usually arrive fully populated; only pay the extra
+        # info() round trip when required fields are actually missing.
+        has_author = author_stats is not None or bool(data.get("authorStats"))
+        if has_author and data.get("stats") and data.get("music"):
+            t = video
+            fetch_stats["skipped"] += 1
+        else:
+            t = api.video(url=watch_url) if watch_url else video
+            await bucket.take()
+            await t.info()
+            data = t.as_dict
+            fetch_stats["refetched"] += 1
+
+        if author_stats is None:
+            author_stats = data.get("authorStats") or {}
+            # never cache an empty result — a later video from the same
+            # creator should get the chance to re-fetch real stats
+            if username and author_stats:
+                author_cache[username] = (author_stats, time.monotonic())
+
+        # ---- music ----
+        music_obj = data.get("music") or {}
+        music_id  = music_obj.get("id") or music_obj.get("musicId") or music_obj.get("idStr")
+        music_uses_count = await music_loader.get(music_id)
+        uses_popular_sound, reason = _popular_sound_heuristic(music_obj, music_uses_count)
+
+        # ---- download ----
+        out_path = os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4")
+        try:
+            await bucket.take()
+            await _download_video(t, out_path)
+        except Exception as e:
+            print(f"   ✗ download failed for {video_id}: {e}")
+            return None
+
+        # polite jitter before releasing the slot
+        await asyncio.sleep(random.uniform(0.3, 0.9))
+
+    # ---- author ----
+    creator_followers   = author_stats.get("followerCount")
+    creator_video_count = author_stats.get("videoCount")
+    creator_total_likes = author_stats.get("heartCount")
+    avg_likes = None
+    if isinstance(creator_video_count, int) and creator_video_count > 0 and isinstance(creator_total_likes, (int,float)):
+        avg_likes = creator_total_likes / creator_video_count
+
+    # ---- video ----
+    create_time_iso = _to_iso(data.get("createTime"))
+    video_obj = data.get("video") or {}
+    video_duration_sec = video_obj.get("duration")
+    caption = data.get("desc") or ""
+    hashtags = _extract_hashtags(data)
+
+    # ---- stats ----
+    stats = data.get("stats") or {}
+    play_count    = stats.get("playCount")
+    like_count    = stats.get("diggCount") or stats.get("likeCount")
+    comment_count = stats.get("commentCount")
+    share_count   = stats.get("shareCount")
+
+    # positional row in _CSV_FIELDS order; callers zip it back into a dict
+    return (
+        video_id, watch_url, username,
+        creator_followers, creator_video_count, creator_total_likes,
+        avg_likes,
+        create_time_iso, video_duration_sec,
+        hashtags, uses_popular_sound, music_uses_count, reason,
+        caption, play_count, like_count, comment_count, share_count, out_path,
+    )
+
+def _is_hard_block(e):
+    """True for 10201/empty-response style blocks that need a fresh session."""
+    if EmptyResponseException is not None and isinstance(e, EmptyResponseException):
+        return True
+    msg = str(e).lower()
+    return "10201" in msg or "empty" in msg or "emptyresponse" in type(e).__name__.lower()
+
+def _retry_after_hint(e):
+    """Seconds the server asked us to wait, when the error carries headers.
+
+    TikTokApi errors sometimes wrap the HTTP response; if a Retry-After or
+    x-ratelimit-reset header is reachable, that beats guessing a backoff.
+    """
+    headers = getattr(getattr(e, "response", None), "headers", None) or getattr(e, "headers", None)
+    if not headers:
+        return None
+    hint = headers.get("Retry-After") or headers.get("retry-after")
+    if hint is not None:
+        try:
+            return float(hint)
+        except (TypeError, ValueError):
+            pass
+    reset = headers.get("x-ratelimit-reset")
+    if reset is not None:
+        try:
+            reset = float(reset)
+        except (TypeError, ValueError):
+            return None
+        # the header is either an epoch timestamp or a plain delta
+        return max(0.0, reset - time.time()) if reset > 1e6 else reset
+    return None
+
 async def _new_session(api):
-    await api.create_sessions(
+    # A pool of SESSION_POOL_SIZE sessions is created up front so TikTokApi
+    # rotates across warm contexts between resets. Tearing down and
+    # rebuilding is only safe between page waves — callers await this with
+    # no API calls in flight.
+    try:
+        await api.close_sessions()
+    except Exception:
+        pass
+    kwargs = dict(
         ms_tokens=[ms_token],
-        num_sessions=1,
+        num_sessions=SESSION_POOL_SIZE,
         sleep_after=2,                # short human-ish pause between calls
         browser=TIKTOK_BROWSER,
-        headless=HEADLESS
+        headless=HEADLESS,
+        suppress_resource_load_types=SUPPRESS_RESOURCE_TYPES,
     )
+    if TIKTOK_BROWSER == "chromium":
+        kwargs["override_browser_args"] = CHROMIUM_ARGS
+    try:
+        await api.create_sessions(**kwargs)
+    except TypeError:
+        # older TikTokApi without the tuning kwargs
+        kwargs.pop("suppress_resource_load_types", None)
+        kwargs.pop("override_browser_args", None)
+        await api.create_sessions(**kwargs)
 
 async def trending_videos():
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
     is_new_csv = not os.path.exists(DATA_CSV_PATH)
-    csv_file = open(DATA_CSV_PATH, "a", newline="", encoding="utf-8")
+    csv_file = open(DATA_CSV_PATH, "a", newline="", encoding="utf-8", buffering=FILE_BUFFER_SIZE)
     csv_writer = csv.writer(csv_file)
     if is_new_csv:
-        csv_writer.writerow([
-            "video_id","watch_url","username",
-            "creator_followers","creator_video_count","creator_total_likes",
-            "avg_likes_per_video",
-            "create_time_iso","video_duration_sec",
-            "hashtags","uses_popular_sound","music_uses_count","popular_sound_reason",
-            "caption","play_count","like_count","comment_count","share_count","download_path"
-        ])
-    jsonl_file = open(DATA_JSONL, "a", encoding="utf-8")
+        csv_writer.writerow(_CSV_FIELDS)
+    # binary mode: rows arrive pre-serialized as bytes lines
+    jsonl_file = open(DATA_JSONL, "ab", buffering=FILE_BUFFER_SIZE)
 
     downloaded_count = 0
-    seen_ids = set()
+    seen_ids = _SeenIds()
     consecutive_errors = 0
+    hard_errors = 0  # 10201/empty-response blocks, tracked apart from item errors
+    last_sleep = BACKOFF_BASE_SEC
     loops = 0
-    music_usage_cache = {}
+    music_usage_cache = _load_music_cache()
+    author_cache = {}  # uniqueId -> (authorStats, cached_at)
+    fetch_stats = {"skipped": 0, "refetched": 0}
+
+    # Incremental resume: skip everything a previous run already banked
+    seeded = _load_seen_ids(seen_ids)
+    if seeded or music_usage_cache:
+        print(f"↺ Resuming: {seeded} videos and {len(music_usage_cache)} sounds already known")
+    atexit.register(_dump_music_cache, music_usage_cache)
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+    # Congestion-aware paging state: settle at whatever size TikTok sustains
+    current_size = PAGE_SIZE
+    page_err_ema = 0.0
+    clean_pages = 0
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+    write_q = asyncio.Queue(maxsize=64)
+    writer = asyncio.create_task(_writer_task(write_q, csv_writer, csv_file, jsonl_file))
 
     async with TikTokApi() as api:
-        await _new_session(api)
-
-        while downloaded_count < COUNT and loops < MAX_LOOPS:
-            loops += 1
-            page_target = min(PAGE_SIZE, COUNT - downloaded_count)
-            print(f"\n=== Page {loops} (need {COUNT - downloaded_count} more; requesting {page_target}) ===")
-
-            try:
-                # Request a SMALL page; big counts often trigger 10201
-                got_any = False
-                async for video in api.trending.videos(count=page_target):
-                    got_any = True
-                    # Guard: stop if we already reached target
-                    if downloaded_count >= COUNT:
-                        break
-
-                    try:
+        bucket = TokenBucket(RATE_LIMIT_RPS, RATE_LIMIT_BURST)
+        music_loader = MusicLoader(api, music_usage_cache, bucket)
+
+        try:
+            await _new_session(api)
+
+            while downloaded_count < COUNT and loops < MAX_LOOPS:
+                # safety valve: too many errors without a single saved row
+                # means the run is going nowhere — stop instead of spinning
+                if consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+                    print(f"🛑 {consecutive_errors} consecutive errors without progress — giving up this run")
+                    break
+                loops += 1
+                page_target = max(PAGE_SIZE_MIN, min(PAGE_SIZE_MAX, int(current_size * (1.0 - page_err_ema) * PAGE_GROWTH)))
+                page_target = min(page_target, COUNT - downloaded_count)
+                print(f"\n=== Page {loops} (need {COUNT - downloaded_count} more; requesting {page_target}) ===")
+
+                try:
+                    # Request a SMALL page; big counts often trigger 10201.
+                    # Collect the page first, then process every item concurrently.
+                    got_any = False
+                    videos = []
+                    await bucket.take()
+                    async for video in api.trending.videos(count=page_target):
+                        got_any = True
                         data = video.as_dict
                         video_id = data.get("id")
                         if not video_id or video_id in seen_ids:
                             continue
                         seen_ids.add(video_id)
-
-                        username = (data.get("author") or {}).get("uniqueId")
-                        watch_url = f"https://www.tiktok.com/@{username}/video/{video_id}" if username else None
-                        t = api.video(url=watch_url) if watch_url else video
-
-                        # load full info
-                        await t.info()
-                        data = t.as_dict
-
-                        # ---- author ----
-                        author_stats = data.get("authorStats") or {}
-                        creator_followers   = author_stats.get("followerCount")
-                        creator_video_count = author_stats.get("videoCount")
-                        creator_total_likes = author_stats.get("heartCount")
-                        avg_likes = None
-                        if isinstance(creator_video_count, int) and creator_video_count > 0 and isinstance(creator_total_likes, (int,float)):
-                            avg_likes = creator_total_likes / creator_video_count
-
-                        # ---- video ----
-                        create_time_iso = _to_iso(data.get("createTime"))
-                        video_obj = data.get("video") or {}
-                        video_duration_sec = video_obj.get("duration")
-                        caption = data.get("desc") or ""
-                        hashtags = _extract_hashtags(data)
-
-                        # ---- music ----
-                        music_obj = data.get("music") or {}
-                        music_id  = music_obj.get("id") or music_obj.get("musicId") or music_obj.get("idStr")
-                        if music_id in music_usage_cache:
-                            music_uses_count = music_usage_cache[music_id]
-                        else:
-                            music_uses_count = await _fetch_music_usage_count(api, music_obj)
-                            music_usage_cache[music_id] = music_uses_count
-                        uses_popular_sound, reason = _popular_sound_heuristic(music_obj, music_uses_count)
-
-                        # ---- stats ----
-                        stats = data.get("stats") or {}
-                        play_count    = stats.get("playCount")
-                        like_count    = stats.get("diggCount") or stats.get("likeCount")
-                        comment_count = stats.get("commentCount")
-                        share_count   = stats.get("shareCount")
-
-                        # ---- download ----
-                        out_path = None
-                        try:
-                            video_bytes = await t.bytes()
-                            out_path = os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4")
-                            with open(out_path, "wb") as f:
-                                f.write(video_bytes)
-                        except Exception as e:
-                            print(f"   ✗ download failed for {video_id}: {e}")
+                        videos.append(video)
+                        if len(videos) >= page_target:
+                            break
+
+                    # If the generator yielded nothing, treat as API block (often 10201)
+                    if not got_any:
+                        raise RuntimeError("Empty page (likely 10201/throttle)")
+
+                    results = await asyncio.gather(
+                        *(_process_item(v, api, sem, music_loader, fetch_stats, bucket, author_cache) for v in videos),
+                        return_exceptions=True,
+                    )
+                    print(f"   (info fetches: {fetch_stats['skipped']} skipped / {fetch_stats['refetched']} refetched so far)")
+
+                    # Rows flow to the dedicated writer task via the queue;
+                    # the main task never touches the file handles directly.
+                    for res in results:
+                        if isinstance(res, BaseException):
+                            print(f"   ✗ item error: {res}")
+                            consecutive_errors += 1
+                            # Only hard blocks count towards a session reset;
+                            # download/network hiccups just get retried.
+                            if _is_hard_block(res):
+                                hard_errors += 1
+                                if hard_errors >= RESET_SESSION_AFTER_ERRORS:
+                                    print("   ↻ restarting session pool due to repeated hard blocks…")
+                                    await _new_session(api)
+                                    hard_errors = 0
+                                    consecutive_errors = 0
                             continue
-
-                        # ---- row ----
-                        row = {
-                            "video_id": video_id,"watch_url": watch_url,"username": username,
-                            "creator_followers": creator_followers,"creator_video_count": creator_video_count,
-                            "creator_total_likes": creator_total_likes,"avg_likes_per_video": avg_likes,
-                            "create_time_iso": create_time_iso,"video_duration_sec": video_duration_sec,
-                            "hashtags": hashtags,"uses_popular_sound": uses_popular_sound,
-                            "music_uses_count": music_uses_count,"popular_sound_reason": reason,
-                            "caption": caption,"play_count": play_count,"like_count": like_count,
-                            "comment_count": comment_count,"share_count": share_count,"download_path": out_path,
-                        }
-
-                        csv_writer.writerow([
-                            row["video_id"],row["watch_url"],row["username"],
-                            row["creator_followers"],row["creator_video_count"],row["creator_total_likes"],
-                            row["avg_likes_per_video"],
-                            row["create_time_iso"],row["video_duration_sec"],
-                            " ".join(row["hashtags"]) if row["hashtags"] else "",
-                            row["uses_popular_sound"],row["music_uses_count"],row["popular_sound_reason"],
-                            row["caption"],row["play_count"],row["like_count"],row["comment_count"],row["share_count"],row["download_path"],
-                        ])
-                        csv_file.flush()
-                        jsonl_file.write(json.dumps(row, ensure_ascii=False) + "\n")
-                        jsonl_file.flush()
+                        if res is None or downloaded_count >= COUNT:
+                            continue
+                        # JSONL keeps hashtags as a list; CSV flattens to one cell
+                        row = dict(zip(_CSV_FIELDS, res))
+                        csv_row = list(res)
+                        csv_row[_HASHTAGS_IDX] = " ".join(row["hashtags"]) if row["hashtags"] else ""
+                        await write_q.put((csv_row, _dumps_jsonl(row)))
 
                         downloaded_count += 1
-                        consecutive_errors = 0  # success resets error counter
+                        consecutive_errors = 0  # success resets error counters
+                        hard_errors = 0
+                        last_sleep = BACKOFF_BASE_SEC
                         print(f"   ✓ saved {downloaded_count}/{COUNT}")
 
-                        # polite jitter between items
-                        await asyncio.sleep(random.uniform(0.3, 0.9))
-
-                    except Exception as e:
-                        print(f"   ✗ item error: {e}")
-                        consecutive_errors += 1
-                        if consecutive_errors >= RESET_SESSION_AFTER_ERRORS:
-                            print("   ↻ restarting session due to consecutive item errors…")
+                    # clean page: decay the error EMA and probe a bigger size
+                    # after a few consecutive successes
+                    page_err_ema *= (1.0 - PAGE_ERR_ALPHA)
+                    clean_pages += 1
+                    if clean_pages >= PAGE_GROW_AFTER:
+                        current_size = min(PAGE_SIZE_MAX, current_size + 5)
+                        clean_pages = 0
+
+                    # small pause between pages
+                    await asyncio.sleep(random.uniform(1.2, 2.5))
+
+                except Exception as e:
+                    # Backoff on API errors (10201/throttle/captcha/etc.)
+                    # Decorrelated jitter (AWS-style): each retry is drawn from
+                    # [base, 3×previous] so clients don't re-sync onto the same
+                    # deterministic exponential schedule during a mass throttle.
+                    consecutive_errors += 1
+                    page_err_ema = PAGE_ERR_ALPHA + (1.0 - PAGE_ERR_ALPHA) * page_err_ema
+                    clean_pages = 0
+                    if _is_hard_block(e):
+                        # congestion signal: halve the page size immediately
+                        current_size = max(PAGE_SIZE_MIN, current_size // 2)
+                    sleep_for = random.uniform(BACKOFF_BASE_SEC, min(BACKOFF_MAX_SEC, last_sleep * 3))
+                    last_sleep = sleep_for
+                    # If the server said exactly when to retry, believe it over our guess
+                    hint = _retry_after_hint(e)
+                    if hint:
+                        sleep_for = max(sleep_for, hint)
+                    print(f"⚠️ Page error: {e} — backing off {sleep_for:.1f}s")
+                    await asyncio.sleep(sleep_for)
+
+                    if _is_hard_block(e):
+                        hard_errors += 1
+                        if hard_errors >= RESET_SESSION_AFTER_ERRORS:
+                            print("↻ Recreating session pool to clear potential verification/throttle…")
                             await _new_session(api)
+                            hard_errors = 0
                             consecutive_errors = 0
-                        continue
-
-                # If the generator yielded nothing, treat as API block (often 10201)
-                if not got_any:
-                    raise RuntimeError("Empty page (likely 10201/throttle)")
-
-                # small pause between pages
-                await asyncio.sleep(random.uniform(1.2, 2.5))
-
-            except Exception as e:
-                # Backoff on API errors (10201/throttle/captcha/etc.)
-                consecutive_errors += 1
-                expo = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * (2 ** min(consecutive_errors, 6)))
-                sleep_for = expo + random.uniform(0, JITTER_SEC)
-                print(f"⚠️ Page error: {e} — backing off {sleep_for:.1f}s")
-                await asyncio.sleep(sleep_for)
 
-                if consecutive_errors >= RESET_SESSION_AFTER_ERRORS:
-                    print("↻ Recreating session to clear potential verification/throttle…")
-                    await _new_session(api)
-                    consecutive_errors = 0
+            # End while
 
-        # End while
+        finally:
+            # drain whatever the writer still holds before tearing anything down
+            await write_q.put(_WRITE_DONE)
+            await writer
 
     csv_file.close()
     jsonl_file.close()